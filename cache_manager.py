@@ -0,0 +1,157 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+import redis.asyncio as aioredis
+from loguru import logger
+from utils import compute_etag
+
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "300"))
+# Larger completions are returned but not cached; they are rarely repeated and crowd out small hits.
+CACHE_MAX_ENTRY_BYTES = int(os.getenv("CACHE_MAX_ENTRY_BYTES", str(128 * 1024)))
+
+class LRUTTLCache:
+    """
+    Size-bounded LRU with per-entry expiry, built on an OrderedDict.
+    Gets and sets are O(1): expiry is checked lazily on the touched key only,
+    and stale entries that are never read again simply age out of the LRU end.
+    Like cachetools, maxsize is measured with getsizeof (entries count 1 by default)
+    and an item larger than maxsize raises ValueError.
+    """
+    def __init__(self, maxsize: int, ttl: float, getsizeof: Optional[Callable[[Any], int]] = None, timer: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.currsize = 0
+        self.timer = timer
+        self._getsizeof = getsizeof or (lambda value: 1)
+        self._data: "OrderedDict[Hashable, Tuple[float, Any, int]]" = OrderedDict()
+
+    def __getitem__(self, key):
+        expires_at, value, _ = self._data[key]
+        if expires_at <= self.timer():
+            self.pop(key)
+            raise KeyError(key)
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = self._getsizeof(value)
+        if size > self.maxsize: raise ValueError("value too large")
+        self.pop(key)
+        while self.currsize + size > self.maxsize:
+            _, (_, _, evicted) = self._data.popitem(last=False)
+            self.currsize -= evicted
+        self._data[key] = (self.timer() + self.ttl, value, size)
+        self.currsize += size
+
+    def __contains__(self, key):
+        try: self[key]
+        except KeyError: return False
+        return True
+
+    def __len__(self): return len(self._data)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None: return default
+        self.currsize -= item[2]
+        return item[1]
+
+    def clear(self):
+        self._data.clear()
+        self.currsize = 0
+
+    def evict_oldest(self, count: int) -> int:
+        """Drops up to `count` least-recently-used entries and returns how many went."""
+        evicted = 0
+        while evicted < count and self._data:
+            _, (_, _, size) = self._data.popitem(last=False)
+            self.currsize -= size
+            evicted += 1
+        return evicted
+
+def memory_pressure(used_fraction: float, low: float = 0.7, high: float = 0.9) -> float:
+    """0 below `low` system memory use, rising linearly to 1 at `high` and above."""
+    return min(1.0, max(0.0, (used_fraction - low) / (high - low)))
+
+class ResponseCache:
+    """
+    Two-tier completion cache: the per-process LRUTTLCache (L1) answers hot keys
+    without a network hop, Redis (L2, optional) shares entries across workers
+    and restarts. Redis errors degrade to L1-only instead of failing requests.
+    Entries are the encoded JSON body plus its ETag; L2 stores only the body.
+    """
+    def __init__(self, l1, redis_client=None, ttl: int = CACHE_TTL_SECONDS):
+        self.l1 = l1
+        self.redis = redis_client
+        self.ttl = ttl
+        # Bound once so the hit path is a single method call and hash lookup.
+        self._l1_get = l1.__getitem__
+        self._l1_set = l1.__setitem__
+
+    async def get(self, key: bytes) -> Optional[Tuple[bytes, str]]:
+        try:
+            return self._l1_get(key)
+        except KeyError:
+            pass
+        if self.redis is None:
+            return None
+        try:
+            body = await self.redis.get(b"cache:" + key)
+        except Exception as e:
+            logger.warning("Redis cache read failed: {}", e)
+            return None
+        if body is None:
+            return None
+        entry = (body, compute_etag(body))
+        try:
+            self._l1_set(key, entry)
+        except ValueError:
+            pass
+        return entry
+
+    async def set(self, key: bytes, body: bytes) -> Tuple[bytes, str]:
+        entry = (body, compute_etag(body))
+        if len(body) > CACHE_MAX_ENTRY_BYTES:
+            return entry
+        try:
+            self._l1_set(key, entry)
+        except ValueError:
+            pass  # larger than the whole L1 byte budget; keep it in L2 only
+        if self.redis is not None:
+            try:
+                await self.redis.set(b"cache:" + key, body, ex=self.ttl)
+            except Exception as e:
+                logger.warning("Redis cache write failed: {}", e)
+        return entry
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one: the first caller starts
+    the work as its own task and every duplicate awaits that task. The task is
+    shielded, so a disconnecting caller does not cancel the result the others need.
+    """
+    def __init__(self):
+        self.inflight: Dict[bytes, asyncio.Task] = {}
+
+    async def do(self, key: bytes, fn: Callable[[], Awaitable]):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: bytes, task: asyncio.Task):
+        self.inflight.pop(key, None)
+        # Mark the exception retrieved even if every waiter went away.
+        if not task.cancelled(): task.exception()
+
+def create_redis_client():
+    return aioredis.from_url(REDIS_URL, decode_responses=False) if REDIS_URL else None
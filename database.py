@@ -1,11 +1,16 @@
 import os
+import orjson
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sql_app.db")
 
 # For SQLite, we need connect_args={"check_same_thread": False}
-engine_kwargs = {}
+engine_kwargs = {
+    # UsageLog stores full request/response payloads in JSON columns; encode them with orjson.
+    "json_serializer": lambda obj: orjson.dumps(obj).decode(),
+    "json_deserializer": orjson.loads,
+}
 if DATABASE_URL.startswith("sqlite"):
     engine_kwargs["connect_args"] = {"check_same_thread": False}
 
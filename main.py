@@ -1,55 +1,69 @@
 import os
-import json
 import sys
 import uuid
 import time
 import asyncio
 import hashlib
+import hmac
+import functools
+import itertools
+import glob
+import threading
+from contextlib import asynccontextmanager
 from typing import Dict, Literal, Tuple, Callable, List, Optional
 from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect, APIRouter, Security, Depends, status
+from fastapi.exceptions import RequestValidationError
 from fastapi.security.api_key import APIKeyHeader
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
+from fastapi.responses import StreamingResponse, Response
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from fastapi.staticfiles import StaticFiles
 from loguru import logger
+from pydantic import ValidationError
 import httpx
-import cachetools
+import orjson
 import psutil
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 import litellm
 from litellm import acompletion
 
-from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-from starlette.middleware.base import BaseHTTPMiddleware
+from limits import parse as parse_limit
 
 import models
 import schemas
 import auth
 from database import get_db, engine, Base
-from utils import generate_cache_key
-from provider_manager import get_provider_key
+from utils import generate_cache_key, error_body, rate_limit_body, ORJSONResponse
+from provider_manager import get_provider_keys, breaker, is_upstream_failure, key_semaphores, key_stats, CircuitOpenError, KeySaturatedError
 from proxy_manager import get_best_proxy, format_proxy_url
+from cache_manager import LRUTTLCache, ResponseCache, SingleFlight, create_redis_client, memory_pressure, CACHE_TTL_SECONDS, REDIS_URL
 
 # Initialize Database
 Base.metadata.create_all(bind=engine)
 
 # --- Resource-Aware Configuration Functions ---
-def get_sync_initial_cache_maxsize() -> int:
+# Sampled once at import; the limit functions below reduce to arithmetic and never call psutil per request.
+CPU_COUNT = os.cpu_count() or 1
+
+def get_sync_initial_cache_max_bytes() -> int:
+    # The cache holds full completion bodies, so it is bounded by bytes rather than entry count.
+    if os.getenv("CACHE_MAX_BYTES"): return int(os.getenv("CACHE_MAX_BYTES"))
     try:
         mem_total_gb = psutil.virtual_memory().total / (1024 ** 3)
-        if mem_total_gb > 7: return 2000
-        elif mem_total_gb > 3.5: return 1000
-        else: return 500
+        if mem_total_gb > 7: return 128 * 1024 ** 2
+        elif mem_total_gb > 3.5: return 64 * 1024 ** 2
+        else: return 32 * 1024 ** 2
     except Exception as e:
-        logger.warning(f"Could not determine system memory for cache sizing, defaulting to 500. Error: {e}")
-        return 500
+        logger.warning(f"Could not determine system memory for cache sizing, defaulting to 32 MB. Error: {e}")
+        return 32 * 1024 ** 2
 
 def get_sync_dynamic_default_limit_str() -> str:
     try:
-        num_cpus = os.cpu_count() or 1
+        num_cpus = CPU_COUNT
         base_rate_per_core = 100
         limit = max(200, num_cpus * base_rate_per_core)
         return f"{limit}/minute"
@@ -57,64 +71,315 @@ def get_sync_dynamic_default_limit_str() -> str:
         logger.warning(f"Could not determine dynamic default rate limit, defaulting to 200/minute. Error: {e}")
         return "200/minute"
 
+BEARER_PREFIX = "Bearer "
+BEARER_PREFIX_LEN = len(BEARER_PREFIX)
+
+def bearer_token(auth_header: Optional[str]) -> Optional[str]:
+    """The token from an `Authorization: Bearer ...` header, or None; shared by rate limiting and auth."""
+    if auth_header and auth_header.startswith(BEARER_PREFIX): return auth_header[BEARER_PREFIX_LEN:].strip()
+    return None
+
+def hash_key(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def api_key_limit_key(api_key: str) -> str:
+    """Counters live in Redis, so they are keyed by the key's hash, never the raw API key."""
+    return "key:" + hash_key(api_key)
+
+def rate_limit_key(request: Request) -> str:
+    # Clients of a shared proxy are API keys, not IPs; anonymous requests fall back to the client address.
+    token = bearer_token(request.headers.get("Authorization"))
+    return api_key_limit_key(token) if token is not None else get_remote_address(request)
+
 # Rate Limiters
-limiter = Limiter(key_func=get_remote_address, default_limits=[get_sync_dynamic_default_limit_str])
+# The sliding-window counter keeps two counters per key like fixed-window, but without the 2x burst at window edges.
+# With REDIS_URL set the counters are shared, so the limit holds across workers instead of multiplying by
+# WEB_CONCURRENCY; if Redis is unreachable slowapi falls back to per-worker memory rather than failing requests.
+limiter = Limiter(
+    key_func=rate_limit_key, strategy="sliding-window-counter",
+    storage_uri=REDIS_URL or "memory://", in_memory_fallback_enabled=bool(REDIS_URL),
+)
+# Inputs are fixed at import, so the limit is computed once; a plain string is parsed once by slowapi
+# at decoration time, whereas a callable would be re-evaluated and re-parsed on every request.
+# CHAT_RATE_LIMIT (e.g. "600/minute") overrides the CPU-derived default.
+CHAT_RATE_LIMIT_STR = os.getenv("CHAT_RATE_LIMIT") or get_sync_dynamic_default_limit_str()
+CHAT_RATE_LIMIT = parse_limit(CHAT_RATE_LIMIT_STR)
+# slowapi's default key_style="url" scopes a route limit by its path; the WebSocket check reuses that scope.
+CHAT_COMPLETIONS_PATH = "/api/v1/chat/completions"
+
+async def ws_rate_limit_ok(api_key: str) -> bool:
+    """WebSocket routes bypass slowapi's decorator, so completions over WS hit the same limit by hand.
+
+    Key and scope match what slowapi uses for the HTTP route, so both transports draw on one counter.
+    The limits storage is synchronous; with Redis behind it the hit runs in a thread so the round-trip
+    does not stall the event loop (slowapi's HTTP check has no async path and still blocks).
+    """
+    hit = functools.partial(limiter.limiter.hit, CHAT_RATE_LIMIT, api_key_limit_key(api_key), CHAT_COMPLETIONS_PATH)
+    try:
+        return await asyncio.to_thread(hit) if REDIS_URL else hit()
+    except Exception as e:
+        # Same fail-open policy as the HTTP path when the shared storage is down.
+        logger.warning("Rate limit storage unavailable: {}", e)
+        return True
+
+# --- Shared Upstream HTTP Client ---
+# Separate phases so dead hosts fail fast on connect while long reads stay allowed.
+# Each phase can be tuned with UPSTREAM_TIMEOUT_<PHASE> (seconds); streams never time out on read.
+HTTP_TIMEOUTS: Dict[str, float] = {
+    phase: float(os.getenv(f"UPSTREAM_TIMEOUT_{phase.upper()}", default))
+    for phase, default in (("connect", 2.0), ("read", 30.0), ("write", 5.0), ("pool", 1.0))
+}
+TIMEOUT_HTTP = httpx.Timeout(**HTTP_TIMEOUTS)
+TIMEOUT_STREAM = httpx.Timeout(**{**HTTP_TIMEOUTS, "read": None})
+
+# The cache budget is fixed at startup, so under real memory pressure it is trimmed proportionally:
+# nothing below 70% system memory use, everything at 90% and above.
+MEMORY_CHECK_SECONDS = float(os.getenv("MEMORY_CHECK_SECONDS", "5"))
+
+def relieve_memory_pressure() -> int:
+    pressure = memory_pressure(psutil.virtual_memory().percent / 100)
+    if not pressure or not len(cache): return 0
+    evicted = cache.evict_oldest(max(1, int(pressure * len(cache))))
+    logger.info("Memory pressure {:.2f}: evicted {} cache entries", pressure, evicted)
+    return evicted
+
+# System CPU use, refreshed by resource_monitor; psutil's non-blocking form measures since the last call.
+CPU_PERCENT = 0.0
+
+async def resource_monitor():
+    global CPU_PERCENT
+    while True:
+        await asyncio.sleep(MEMORY_CHECK_SECONDS)
+        try:
+            CPU_PERCENT = psutil.cpu_percent(interval=None)
+            relieve_memory_pressure()
+        except Exception as e: logger.warning("Resource check failed: {}", e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging()
+    # A single pooled client keeps TCP/TLS connections to providers alive across requests.
+    app.state.http = httpx.AsyncClient(
+        timeout=TIMEOUT_HTTP,
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100, keepalive_expiry=15.0),
+        http2=True,
+    )
+    litellm.aclient_session = app.state.http
+    monitor = asyncio.create_task(resource_monitor())
+    try:
+        yield
+    finally:
+        monitor.cancel()
+        litellm.aclient_session = None
+        await app.state.http.aclose()
+        await response_cache.close()
 
 app = FastAPI(
     title="Universal AI Proxy API",
     description="Professional multi-provider AI Proxy Gateway.",
     version="3.2",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
+    # Replaces slowapi's stdlib-json handler; rate-limit headers are not enabled, so there is nothing to inject.
+    return Response(content=rate_limit_body(exc.detail), status_code=429, media_type="application/json")
+
+app.add_exception_handler(RateLimitExceeded, rate_limit_exceeded_handler)
+
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    if exc.status_code in (204, 304): return Response(status_code=exc.status_code, headers=exc.headers)
+    body = error_body(exc.detail) if isinstance(exc.detail, str) else orjson.dumps({"detail": exc.detail})
+    return Response(content=body, status_code=exc.status_code, media_type="application/json", headers=exc.headers)
+
+app.add_exception_handler(StarletteHTTPException, http_exception_handler)
+
+LOG_BUFFER_BYTES = int(os.getenv("LOG_BUFFER_BYTES", str(32 * 1024)))
+LOG_FLUSH_SECONDS = float(os.getenv("LOG_FLUSH_SECONDS", "1"))
+LOG_ROTATION_BYTES = 10 * 1024 * 1024
+
+LOG_RETENTION_SECONDS = 10 * 24 * 3600
+
+class BatchSink:
+    """
+    loguru sink for app.log that batches records: they collect in memory and reach the file in one
+    write() once buffer_bytes have piled up or flush_seconds have passed, whichever comes first.
+    It owns rotation too: past rotation_bytes the file is renamed with a timestamp suffix and
+    rotated files older than retention_seconds are deleted. Written from loguru's queue thread
+    and flushed from its own timer thread, so both paths go through one lock.
+    """
+    def __init__(self, path: str, buffer_bytes: int, flush_seconds: float, rotation_bytes: int, retention_seconds: float):
+        self.path = path
+        self.buffer_bytes = buffer_bytes
+        self.rotation_bytes = rotation_bytes
+        self.retention_seconds = retention_seconds
+        self.buffer: List[str] = []
+        self.buffered = 0
+        self.file = None
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self._flush_periodically, args=(flush_seconds,), name="app-log-flush", daemon=True)
+        self.timer.start()
+
+    # Not named flush(): loguru calls a sink's flush() after every write, which would defeat batching.
+    def write(self, message: str):
+        with self.lock:
+            self.buffer.append(message)
+            self.buffered += len(message)
+            if self.buffered >= self.buffer_bytes: self._write_buffer()
+
+    def flush_buffer(self):
+        with self.lock: self._write_buffer()
+
+    def stop(self):
+        self.stopped.set()
+        self.timer.join()
+        with self.lock:
+            self._write_buffer()
+            if self.file is not None: self.file.close(); self.file = None
+
+    def _flush_periodically(self, flush_seconds: float):
+        while not self.stopped.wait(flush_seconds): self.flush_buffer()
+
+    def _write_buffer(self):
+        if not self.buffer: return
+        data = "".join(self.buffer)
+        self.buffer.clear()
+        self.buffered = 0
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.size = self.file.tell()
+        if self.size and self.size + len(data) > self.rotation_bytes: self._rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def _rotate(self):
+        self.file.close()
+        root, ext = os.path.splitext(self.path)
+        os.replace(self.path, f"{root}.{time.strftime('%Y-%m-%d_%H-%M-%S')}{ext}")
+        cutoff = time.time() - self.retention_seconds
+        for old in glob.glob(f"{glob.escape(root)}.*{ext}"):
+            if os.path.getmtime(old) < cutoff: os.remove(old)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.size = 0
+
+SLOW_REQUEST_NS = int(float(os.getenv("SLOW_REQUEST_MS", "100")) * 1_000_000)
+# Above this CPU use, only errors and 1 in ACCESS_LOG_SAMPLE_EVERY other requests are logged.
+ACCESS_LOG_CPU_THRESHOLD = 85.0
+ACCESS_LOG_SAMPLE_EVERY = 16
+access_log_seq = itertools.count()
+
+class LoggingMiddleware:
+    """Pure ASGI access-log middleware; avoids BaseHTTPMiddleware's extra task and body buffering."""
+    def __init__(self, app):
+        self.app = app
+    async def __call__(self, scope, receive, send):
+        # Static assets are not access-logged at all: no timing, no wrapper, no log record.
+        if scope["type"] != "http" or scope["path"].startswith("/static"):
+            return await self.app(scope, receive, send)
+        start = time.perf_counter_ns()
+        status_holder = {"code": 500}
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start": status_holder["code"] = message["status"]
+            await send(message)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            code = status_holder["code"]
+            sampled_out = code < 400 and CPU_PERCENT > ACCESS_LOG_CPU_THRESHOLD and next(access_log_seq) % ACCESS_LOG_SAMPLE_EVERY
+            if not sampled_out:
+                elapsed_ns = time.perf_counter_ns() - start
+                # Only errors and slow requests reach INFO; fast successes stay at DEBUG.
+                # Loguru formats lazily, so a dropped record costs no string formatting.
+                log = logger.info if code >= 400 or elapsed_ns >= SLOW_REQUEST_NS else logger.debug
+                log("{} {} {} {:.1f}ms", scope["method"], scope["path"], code, elapsed_ns / 1e6)
+
+app.add_middleware(LoggingMiddleware)
 
 os.makedirs("static", exist_ok=True)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-logger.configure(handlers=[{"sink": sys.stderr, "level": "INFO"}])
-
-cache = cachetools.TTLCache(maxsize=get_sync_initial_cache_maxsize(), ttl=300)
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+
+def configure_logging():
+    """
+    Installs the log sinks; called from lifespan so importing main (tests, tooling) leaves loguru alone.
+    All sinks are queued so disk writes happen on loguru's worker thread, off the event loop.
+    app.log is JSON lines without extended tracebacks; full tracebacks only go to errors.log.
+    app.log goes through BatchSink, so many records share one write() instead of one syscall per
+    request and reach disk at least every LOG_FLUSH_SECONDS; errors.log stays line-buffered.
+    """
+    os.makedirs(LOG_DIR, exist_ok=True)
+    logger.remove()
+    app_log = BatchSink(os.path.join(LOG_DIR, "app.log"), LOG_BUFFER_BYTES, LOG_FLUSH_SECONDS, LOG_ROTATION_BYTES, LOG_RETENTION_SECONDS)
+    logger.add(app_log, level=os.getenv("LOG_FILE_LEVEL", "INFO"), enqueue=True, backtrace=False, diagnose=False, serialize=True)
+    logger.add(os.path.join(LOG_DIR, "errors.log"), level="ERROR", rotation="10 MB", retention="10 days", enqueue=True, backtrace=True, diagnose=False)
+    # Fast successful requests log at DEBUG, so at INFO (the default for both) only slow or failed ones are kept.
+    # Set LOG_LEVEL=WARNING in production to keep per-request records off stderr entirely.
+    logger.add(sys.stderr, level=os.getenv("LOG_LEVEL", "INFO"), enqueue=True)
+
+cache = LRUTTLCache(maxsize=get_sync_initial_cache_max_bytes(), ttl=CACHE_TTL_SECONDS, getsizeof=lambda entry: len(entry[0]))
+response_cache = ResponseCache(cache, create_redis_client())
+# Identical uncached requests in flight at the same time share one upstream call.
+completion_flights = SingleFlight()
 
 class ConnectionManager:
+    # No lock: dict get/set/pop are atomic between awaits on a single event loop,
+    # and holding a lock across send_text would serialize every socket's sends.
+    # The registry is per worker process; cross-worker fan-out would need Redis pub/sub, not a lock.
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.lock = asyncio.Lock()
-    async def connect(self, websocket: WebSocket, connection_id: str):
+        self.active_connections: Dict[int, WebSocket] = {}
+    async def connect(self, websocket: WebSocket, connection_id: int):
         await websocket.accept()
-        async with self.lock: self.active_connections[connection_id] = websocket
-    async def disconnect(self, connection_id: str):
-        async with self.lock:
-            if connection_id in self.active_connections: del self.active_connections[connection_id]
-    async def send_message(self, connection_id: str, message: str) -> bool:
-        async with self.lock:
-            if connection_id in self.active_connections:
-                try:
-                    await self.active_connections[connection_id].send_text(message)
-                    return True
-                except Exception as e:
-                    logger.error(f"Error sending message to {connection_id}: {e}")
-                    return False
-        return False
+        self.active_connections[connection_id] = websocket
+    def disconnect(self, connection_id: int):
+        self.active_connections.pop(connection_id, None)
 manager = ConnectionManager()
-
-def hash_key(key: str) -> str:
-    return hashlib.sha256(key.encode()).hexdigest()
+# Process-local connection ids; never exposed to clients, so no need for uuid4's urandom read.
+connection_ids = itertools.count(1)
+
+# WebSocket stream coalescing thresholds, for clients that opt in with {"coalesce": true}
+WS_FLUSH_BYTES = 4096
+WS_FLUSH_INTERVAL = 0.02
+# Backpressure: at most this many encoded chunks wait per client, and an upstream chunk
+# that cannot be queued (or a frame that cannot be sent) within WS_SLOW_CLIENT_TIMEOUT aborts the stream.
+WS_QUEUE_MAX = 64
+WS_SLOW_CLIENT_TIMEOUT = 30.0
+
+async def receive_json_fast(websocket: WebSocket):
+    """orjson replacement for WebSocket.receive_json that accepts text or binary frames."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect": raise WebSocketDisconnect(message.get("code", 1000))
+    return orjson.loads(message.get("text") or message.get("bytes") or b"")
+
+async def send_json_fast(websocket: WebSocket, data) -> None:
+    await websocket.send_text(orjson.dumps(data).decode())
+
+BOOTSTRAP_KEY_HASH = hash_key("test-api-key")
+
+def is_bootstrap_key(hashed: str) -> bool:
+    """Matches the setup-only test key by hash in constant time, so the comparison leaks no timing."""
+    return hmac.compare_digest(hashed, BOOTSTRAP_KEY_HASH)
+
+def resolve_api_key(db: Session, api_key: str) -> Optional[models.User]:
+    """Shared by HTTP and WebSocket auth: the key's owner, None for the bootstrap key, else 403."""
+    hashed = hash_key(api_key)
+    db_key = db.query(models.APIKey).filter(models.APIKey.key == hashed, models.APIKey.is_active == True).first()
+    if db_key: return db_key.owner
+    if is_bootstrap_key(hashed) and db.query(models.User).count() == 0: return None
+    raise HTTPException(status_code=403, detail="Invalid API Key")
 
 async def verify_api_key(request: Request, db: Session = Depends(get_db)):
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
+    api_key = bearer_token(request.headers.get("Authorization"))
+    if api_key is None:
         api_key = request.query_params.get("api_key")
         if not api_key: raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    else:
-        api_key = auth_header.replace("Bearer ", "").strip()
 
-    hashed = hash_key(api_key)
-    db_key = db.query(models.APIKey).filter(models.APIKey.key == hashed, models.APIKey.is_active == True).first()
-    if not db_key:
-        if api_key == "test-api-key" and db.query(models.User).count() == 0: return None
-        raise HTTPException(status_code=403, detail="Invalid API Key")
-    return db_key.owner
+    return resolve_api_key(db, api_key)
 
 @app.post("/token", response_model=schemas.Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
@@ -133,30 +398,118 @@ async def register_user(user: schemas.UserCreate, db: Session = Depends(get_db))
     new_user = models.User(username=user.username, email=user.email, hashed_password=auth.get_password_hash(user.password), is_admin=is_admin)
     db.add(new_user); db.commit(); db.refresh(new_user); return {"message": "User created successfully"}
 
+# Hedging is opt-in: the provider bills the losing call too, and a unary completion usually takes
+# seconds, so a short delay would double most requests. Unset or 0 means plain sequential failover.
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY_MS", "0")) / 1000 or None
+# Keys per request for failover after errors; they are never raced against each other by default.
+MAX_PROVIDER_ATTEMPTS = int(os.getenv("MAX_PROVIDER_ATTEMPTS", "3"))
+
+def build_base_kwargs(request_data: dict, proxy_url: Optional[str], stream: bool) -> dict:
+    """Key-independent LiteLLM arguments, built once per request and shared by every attempt."""
+    base_kwargs = {**request_data, "timeout": TIMEOUT_STREAM if stream else TIMEOUT_HTTP}
+    if proxy_url: base_kwargs["proxy_url"] = proxy_url
+    return base_kwargs
+
+def build_litellm_kwargs(base_kwargs: dict, provider_key_obj: models.ProviderKey) -> dict:
+    litellm_kwargs = {**base_kwargs, "api_key": provider_key_obj.api_key}
+    if provider_key_obj.config and 'base_url' in provider_key_obj.config: litellm_kwargs["api_base"] = provider_key_obj.config['base_url']
+    if provider_key_obj.provider == "openai-compatible": litellm_kwargs["custom_llm_provider"] = "openai"
+    return litellm_kwargs
+
+async def call_provider(provider_key_obj: models.ProviderKey, litellm_kwargs: dict):
+    # Half-open probes are claimed here, when a call really starts, not when the key is selected:
+    # hedging selects backup keys that are usually never called.
+    # Fail fast instead of queueing on a full bulkhead, so the caller moves on to the next key.
+    # Checked before the breaker so a rejected call does not use up a half-open probe.
+    semaphore = key_semaphores[provider_key_obj.id]
+    if semaphore.locked(): raise KeySaturatedError(f"Provider key {provider_key_obj.id} is saturated")
+    if not breaker.begin_call(provider_key_obj.id): raise CircuitOpenError(f"Circuit open for provider key {provider_key_obj.id}")
+    start = time.perf_counter()
+    try:
+        # Acquiring an unlocked semaphore does not suspend, so nothing can fill it after the check.
+        # For streams the permit covers only opening the stream, not how long it is consumed.
+        async with semaphore:
+            response = await acompletion(**litellm_kwargs)
+    except asyncio.CancelledError:
+        breaker.release_probe(provider_key_obj.id)
+        raise
+    except Exception as e:
+        if is_upstream_failure(e):
+            breaker.record_failure(provider_key_obj.id)
+            key_stats.record(provider_key_obj.id, time.perf_counter() - start, ok=False)
+        else: breaker.release_probe(provider_key_obj.id)
+        raise
+    breaker.record_success(provider_key_obj.id)
+    key_stats.record(provider_key_obj.id, time.perf_counter() - start, ok=True)
+    return response
+
+async def hedged_completion(attempts: List[Tuple[models.ProviderKey, dict]], hedge_delay: Optional[float]):
+    """
+    Tries attempts in order, moving to the next key only once the in-flight call has failed.
+    With hedge_delay set, one extra call (at most) is fired at the next key if nothing has
+    answered within hedge_delay, and only when that key shares the first key's priority;
+    the first success wins and the other call is cancelled.
+    """
+    remaining = list(attempts)
+    top_priority = remaining[0][0].priority
+    pending = {asyncio.create_task(call_provider(*remaining.pop(0)))}
+    hedged = hedge_delay is None
+    last_error = None
+    try:
+        while pending:
+            can_hedge = not hedged and remaining and remaining[0][0].priority == top_priority
+            done, pending = await asyncio.wait(pending, timeout=hedge_delay if can_hedge else None, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None: return task.result()
+                last_error = task.exception()
+            if not done:
+                hedged = True
+                pending.add(asyncio.create_task(call_provider(*remaining.pop(0))))
+            elif not pending and remaining:
+                pending.add(asyncio.create_task(call_provider(*remaining.pop(0))))
+        raise last_error
+    finally:
+        for task in pending: task.cancel()
+
 async def handle_ai_completion(body: schemas.CompletionRequest, user: Optional[models.User], db: Session, country: str = None):
+    """
+    Streaming requests return the stream; all others return
+    (encoded JSON body, ETag, "HIT" | "MISS"), served from the response cache when possible.
+    """
     request_data = body.model_dump(exclude_unset=True)
+    if body.stream: return await request_completion(body, request_data, None, user, db, country)
     cache_key = generate_cache_key(request_data)
-    if cache_key in cache and not body.stream: return cache[cache_key], None
-
-    provider_key_obj = get_provider_key(db, body.model)
-    if not provider_key_obj: raise HTTPException(status_code=503, detail="No active provider keys available for this model")
+    cached = await response_cache.get(cache_key)
+    if cached is not None: return (*cached, "HIT")
+    bind = db.get_bind()
+    entry = await completion_flights.do(cache_key, lambda: flight_completion(body, request_data, cache_key, user, bind, country))
+    return (*entry, "MISS")
+
+async def flight_completion(body: schemas.CompletionRequest, request_data: dict, cache_key: bytes, user: Optional[models.User], bind, country: str = None):
+    """
+    Runs a single-flight upstream call on its own Session. The flight is shielded and can outlive
+    the leader request, whose Session get_db closes as soon as that request ends or is cancelled.
+    """
+    with Session(bind=bind) as db:
+        return await request_completion(body, request_data, cache_key, user, db, country)
+
+async def request_completion(body: schemas.CompletionRequest, request_data: dict, cache_key: Optional[bytes], user: Optional[models.User], db: Session, country: str = None):
+    """The upstream call behind handle_ai_completion; non-stream results are cached and logged once per flight."""
+    provider_keys = get_provider_keys(db, body.model, limit=MAX_PROVIDER_ATTEMPTS)
+    if not provider_keys: raise HTTPException(status_code=503, detail="No active provider keys available for this model")
 
     proxy_obj = get_best_proxy(db, country=country)
     proxy_url = format_proxy_url(proxy_obj) if proxy_obj else None
-
-    litellm_kwargs = {**request_data}
-    litellm_kwargs["api_key"] = provider_key_obj.api_key
-    if provider_key_obj.config and 'base_url' in provider_key_obj.config: litellm_kwargs["api_base"] = provider_key_obj.config['base_url']
-    if proxy_url: litellm_kwargs["proxy_url"] = proxy_url
-    if provider_key_obj.provider == "openai-compatible": litellm_kwargs["custom_llm_provider"] = "openai"
+    base_kwargs = build_base_kwargs(request_data, proxy_url, body.stream)
+    attempts = [(key, build_litellm_kwargs(base_kwargs, key)) for key in provider_keys]
 
     try:
-        start_time = time.time()
-        response = await acompletion(**litellm_kwargs)
-        if body.stream: return response, start_time
+        # Streams are not hedged: a losing stream could not be closed cleanly once opened.
+        response = await hedged_completion(attempts, None if body.stream else HEDGE_DELAY)
+        if body.stream: return response
 
         response_json = response.model_dump()
-        cache[cache_key] = response_json
+        entry = await response_cache.set(cache_key, orjson.dumps(response_json))
 
         usage = response_json.get('usage', {})
         new_log = models.UsageLog(
@@ -166,52 +519,130 @@ async def handle_ai_completion(body: schemas.CompletionRequest, user: Optional[m
             request_data=request_data, response_data=response_json, status_code=200
         )
         db.add(new_log); db.commit()
-        return response_json, None
+        return entry
     except Exception as e:
-        logger.error(f"LiteLLM Error: {str(e)}")
+        logger.error("LiteLLM Error: {}", e)
         raise HTTPException(status_code=500, detail=f"AI Provider Error: {str(e)}")
 
-@app.post("/api/v1/chat/completions")
+async def completion_request_body(request: Request) -> schemas.CompletionRequest:
+    """Validates the raw body in one pydantic-core pass instead of FastAPI's json.loads plus a walk of the dict."""
+    try:
+        return schemas.CompletionRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        # Same 422 shape FastAPI produces for a declared body parameter.
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]) from None
+
+@app.post(CHAT_COMPLETIONS_PATH, openapi_extra=schemas.COMPLETION_REQUEST_OPENAPI)
+@limiter.limit(CHAT_RATE_LIMIT_STR)
 async def api_v1_chat_completions(
-    body: schemas.CompletionRequest,
+    request: Request,
+    body: schemas.CompletionRequest = Depends(completion_request_body),
     user: Optional[models.User] = Depends(verify_api_key),
     db: Session = Depends(get_db),
     country: Optional[str] = None
 ):
-    response, start_time = await handle_ai_completion(body, user, db, country=country)
+    result = await handle_ai_completion(body, user, db, country=country)
     if body.stream:
+        response = result
         async def stream_generator():
-            async for chunk in response: yield f"data: {json.dumps(chunk.model_dump())}\n\n"
-            yield "data: [DONE]\n\n"
+            # Forward each chunk as pre-encoded SSE bytes; nothing is buffered server-side.
+            async for chunk in response: yield b"data: " + orjson.dumps(chunk.model_dump()) + b"\n\n"
+            yield b"data: [DONE]\n\n"
         return StreamingResponse(stream_generator(), media_type="text/event-stream")
-    return JSONResponse(content=response)
+    content, etag, cache_status = result
+    headers = {"ETag": etag, "X-Cache": cache_status}
+    if request.headers.get("if-none-match") == etag: return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
 
 @app.websocket("/ws/v1/chat/completions")
 async def ws_v1_chat_completions(websocket: WebSocket, db: Session = Depends(get_db)):
-    connection_id = str(uuid.uuid4())
+    connection_id = next(connection_ids)
     await manager.connect(websocket, connection_id)
     try:
-        auth_data = await websocket.receive_json()
-        api_key = auth_data.get("api_key", "").replace("Bearer ", "").strip()
+        auth_data = await receive_json_fast(websocket)
+        api_key = auth_data.get("api_key", "").removeprefix(BEARER_PREFIX).strip()
         country = auth_data.get("country")
-        hashed = hash_key(api_key)
-        db_key = db.query(models.APIKey).filter(models.APIKey.key == hashed, models.APIKey.is_active == True).first()
-        user = db_key.owner if db_key else None
-        if not db_key and not (api_key == "test-api-key" and db.query(models.User).count() == 0):
-            await websocket.send_json({"error": "Invalid API Key"}); await websocket.close(); return
-        config = await websocket.receive_json()
+        try: user = resolve_api_key(db, api_key)
+        except HTTPException as e:
+            await send_json_fast(websocket, {"error": e.detail}); await websocket.close(); return
+        if not await ws_rate_limit_ok(api_key):
+            await send_json_fast(websocket, {"error": "Rate limit exceeded"}); await websocket.close(code=1008); return
+        config = await receive_json_fast(websocket)
         body = schemas.CompletionRequest(**config)
         body.stream = True
-        response, start_time = await handle_ai_completion(body, user, db, country=country)
-        async for chunk in response:
-            if not await manager.send_message(connection_id, json.dumps(chunk.model_dump())): break
-        await manager.send_message(connection_id, "[DONE]")
-    except WebSocketDisconnect: logger.info(f"WS disconnected: {connection_id}")
+        response = await handle_ai_completion(body, user, db, country=country)
+        # By default every chunk is its own JSON frame. Clients that opt in with {"coalesce": true} get
+        # newline-delimited batches (NDJSON) that cut per-frame overhead; with {"binary": true} frames
+        # are raw bytes and skip the UTF-8 decode.
+        binary = bool(auth_data.get("binary"))
+        flush_bytes = WS_FLUSH_BYTES if auth_data.get("coalesce") else 0
+        buffer = bytearray()
+        async def flush():
+            send = websocket.send_bytes(bytes(buffer)) if binary else websocket.send_text(buffer.decode())
+            buffer.clear()
+            try: await asyncio.wait_for(send, WS_SLOW_CLIENT_TIMEOUT)
+            except asyncio.TimeoutError:
+                # The client stopped reading; close and drop it instead of holding the upstream stream open.
+                try: await asyncio.wait_for(websocket.close(code=1008), 1.0)
+                except Exception: pass
+                raise WebSocketDisconnect(code=1008) from None
+        # A reader task feeds the queue so a partly filled buffer is flushed on its deadline even while
+        # the upstream is quiet. `slots` bounds the chunks waiting per client, so a slow client caps
+        # memory; the queue itself is unbounded so the end-of-stream sentinel never blocks.
+        queue: asyncio.Queue = asyncio.Queue()
+        slots = asyncio.Semaphore(WS_QUEUE_MAX)
+        async def pump():
+            try:
+                async for chunk in response:
+                    # wait_for wraps its awaitable in a Task; only pay for that when there is no free slot.
+                    if slots.locked():
+                        try: await asyncio.wait_for(slots.acquire(), WS_SLOW_CLIENT_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            raise RuntimeError("Client is not reading; stream aborted") from None
+                    else: await slots.acquire()
+                    queue.put_nowait(orjson.dumps(chunk.model_dump()))
+            finally:
+                queue.put_nowait(None)
+                # Release the upstream connection now rather than whenever the generator is collected.
+                aclose = getattr(response, "aclose", None)
+                if aclose is not None:
+                    try: await aclose()
+                    except Exception: pass
+        loop = asyncio.get_running_loop()
+        producer = asyncio.create_task(pump())
+        try:
+            deadline = None
+            while True:
+                if buffer and loop.time() >= deadline:
+                    await flush()
+                if not queue.empty(): data = queue.get_nowait()
+                else:
+                    # Only a finite timeout makes wait_for create a Task; with an empty buffer it awaits directly.
+                    try: data = await asyncio.wait_for(queue.get(), deadline - loop.time() if buffer else None)
+                    except asyncio.TimeoutError:
+                        await flush(); continue
+                if data is None: break
+                slots.release()
+                if not buffer: deadline = loop.time() + WS_FLUSH_INTERVAL
+                else: buffer += b"\n"
+                buffer += data
+                if len(buffer) >= flush_bytes: await flush()
+            if buffer: await flush()
+            await producer
+        finally:
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+        await websocket.send_text("[DONE]")
+    except WebSocketDisconnect: logger.debug("WS disconnected: {}", connection_id)
+    except orjson.JSONDecodeError:
+        # Malformed client frames are the client's fault; keep them out of errors.log.
+        try: await send_json_fast(websocket, {"error": "Invalid JSON"})
+        except: pass
     except Exception as e:
-        logger.error(f"WS Error: {str(e)}")
-        try: await websocket.send_json({"error": str(e)})
+        logger.error("WS Error: {}", e)
+        try: await send_json_fast(websocket, {"error": str(e)})
         except: pass
-    finally: await manager.disconnect(connection_id)
+    finally: manager.disconnect(connection_id)
 
 @app.post("/admin/providers", dependencies=[Depends(auth.get_current_admin_user)])
 async def add_provider(provider_in: schemas.ProviderKeyCreate, db: Session = Depends(get_db)):
@@ -233,6 +664,9 @@ async def delete_proxy(proxy_id: int, db: Session = Depends(get_db)):
     if not proxy: raise HTTPException(status_code=404, detail="Proxy not found")
     db.delete(proxy); db.commit(); return {"message": "Proxy deleted"}
 
+@app.get("/admin/cache", dependencies=[Depends(auth.get_current_admin_user)])
+async def get_cache_stats(): return {"entries": len(cache), "bytes": cache.currsize, "max_bytes": cache.maxsize, "ttl": cache.ttl}
+
 @app.get("/admin/usage", dependencies=[Depends(auth.get_current_admin_user)])
 async def get_all_usage(db: Session = Depends(get_db)): return db.query(models.UsageLog).order_by(models.UsageLog.created_at.desc()).limit(100).all()
 
@@ -282,9 +716,21 @@ async def get_user_stats(current_user: models.User = Depends(auth.get_current_ac
         "model_stats": model_stats
     }
 
+HOME_HTML = b"<h1>AI Proxy v3.2</h1><p>Visit /docs for API documentation.</p>"
+HOME_HEADERS = {"content-type": "text/html; charset=utf-8", "content-length": str(len(HOME_HTML))}
+
 @app.get("/", include_in_schema=False)
-async def serve_home(): return HTMLResponse(content="<h1>AI Proxy v3.2</h1><p>Visit /docs for API documentation.</p>")
+async def serve_home(): return Response(content=HOME_HTML, headers=HOME_HEADERS)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8100)
+    if os.getenv("DEV"):
+        uvicorn.run("main:app", host="0.0.0.0", port=8100, reload=True)
+    else:
+        uvicorn.run(
+            "main:app", host="0.0.0.0", port=8100,
+            loop="uvloop" if sys.platform != "win32" else "asyncio", http="httptools", ws="websockets",
+            workers=int(os.getenv("WEB_CONCURRENCY", CPU_COUNT)),
+            access_log=False,  # LoggingMiddleware already writes the access log
+            ws_ping_interval=30, ws_ping_timeout=60,
+        )
@@ -1,22 +1,149 @@
+import os
 import random
+import time
+import asyncio
+from collections import defaultdict
+from typing import Dict, Tuple
+import litellm
 from sqlalchemy.orm import Session
 from models import ProviderKey
 
-def get_provider_key(db: Session, model: str):
+class Breaker:
+    """Per-provider-key circuit state: closed -> open -> half_open -> closed."""
+    def __init__(self):
+        self.state = "closed"
+        self.fail_count = 0
+        self.opened_at = 0.0
+        self.probes = 0
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider key whose breaker has no probe left."""
+
+class KeySaturatedError(Exception):
+    """Raised instead of queueing behind a provider key that already has MAX_IN_FLIGHT_PER_KEY calls."""
+
+class CircuitBreaker:
+    """
+    Short-circuits provider keys that keep failing so requests skip them
+    instead of paying a full upstream timeout each time.
+    All methods are synchronous, so they never interleave on the event loop.
+    """
+    def __init__(self, failure_threshold: int = 5, open_seconds: float = 10.0, half_open_requests: int = 3):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_requests = half_open_requests
+        self.breakers: Dict[int, Breaker] = {}
+
+    def allow(self, key_id: int) -> bool:
+        """Selection-time check; it does not use up a half-open probe, begin_call does."""
+        b = self.breakers.get(key_id)
+        if b is None or b.state == "closed":
+            return True
+        if b.state == "open":
+            if time.monotonic() - b.opened_at < self.open_seconds:
+                return False
+            b.state, b.probes = "half_open", 0
+        return b.probes < self.half_open_requests
+
+    def begin_call(self, key_id: int) -> bool:
+        """Claims a half-open probe when a call actually starts; False once none are left."""
+        if not self.allow(key_id):
+            return False
+        b = self.breakers.get(key_id)
+        if b is not None and b.state == "half_open":
+            b.probes += 1
+        return True
+
+    def release_probe(self, key_id: int):
+        """A probe that ended without a verdict (cancelled hedge loser, client error) frees its slot."""
+        b = self.breakers.get(key_id)
+        if b is not None and b.state == "half_open" and b.probes:
+            b.probes -= 1
+
+    def record_success(self, key_id: int):
+        self.breakers.pop(key_id, None)
+
+    def record_failure(self, key_id: int):
+        b = self.breakers.setdefault(key_id, Breaker())
+        b.fail_count += 1
+        if b.state == "half_open" or b.fail_count >= self.failure_threshold:
+            b.state, b.opened_at = "open", time.monotonic()
+
+breaker = CircuitBreaker()
+
+class KeyStats:
+    """
+    Per-provider-key EWMA of latency (seconds) and failure rate, used to order
+    keys of equal priority so the fastest healthy key is tried first.
+    Keys without samples score 0, so new keys get tried and measured. A key's
+    score also halves every `half_life` seconds without a sample, so a key that
+    was penalised and then skipped drifts back to the front and gets re-measured.
+    """
+    def __init__(self, alpha: float = 0.2, failure_penalty: float = 10.0, half_life: float = 60.0):
+        self.alpha = alpha
+        self.failure_penalty = failure_penalty
+        self.half_life = half_life
+        self.stats: Dict[int, Tuple[float, float, float]] = {}
+
+    def record(self, key_id: int, latency: float, ok: bool):
+        prev = self.stats.get(key_id)
+        failed = 0.0 if ok else 1.0
+        now = time.monotonic()
+        if prev is None:
+            self.stats[key_id] = (latency, failed, now)
+        else:
+            a = self.alpha
+            self.stats[key_id] = ((1 - a) * prev[0] + a * latency, (1 - a) * prev[1] + a * failed, now)
+
+    def score(self, key_id: int) -> float:
+        stats = self.stats.get(key_id)
+        if stats is None:
+            return 0.0
+        latency, failure_rate, updated_at = stats
+        decay = 0.5 ** ((time.monotonic() - updated_at) / self.half_life)
+        return (latency + self.failure_penalty * failure_rate) * decay
+
+key_stats = KeyStats(half_life=float(os.getenv("KEY_STATS_HALF_LIFE_SECONDS", "60")))
+
+# Bulkhead: cap in-flight upstream calls per provider key so one slow provider
+# cannot absorb every request; saturated keys are skipped during selection, and a key that
+# fills up between selection and the call is rejected (KeySaturatedError) rather than queued.
+MAX_IN_FLIGHT_PER_KEY = int(os.getenv("MAX_IN_FLIGHT_PER_KEY", "50"))
+key_semaphores: Dict[int, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(MAX_IN_FLIGHT_PER_KEY))
+
+def is_saturated(key_id: int) -> bool:
+    sem = key_semaphores.get(key_id)
+    return sem is not None and sem.locked()
+
+def is_upstream_failure(exc: Exception) -> bool:
+    """Only timeouts, connection errors and 5xx trip the breaker; 4xx are the caller's fault."""
+    if isinstance(exc, (litellm.Timeout, litellm.APIConnectionError)):
+        return True
+    status_code = getattr(exc, "status_code", None)
+    return isinstance(status_code, int) and status_code >= 500
+
+def get_provider_keys(db: Session, model: str, limit: int = 2):
     """
-    Retrieves an active provider key for the given model.
-    For now, it returns a random active key.
+    Returns up to `limit` active provider keys for the given model, in the order
+    they should be tried: highest priority first, then lowest EWMA latency/failure
+    score (random among ties), skipping any that are saturated or whose circuit breaker is open.
     Later we can add model-specific routing logic.
     """
     keys = db.query(ProviderKey).filter(ProviderKey.is_active == True).all()
-    if not keys:
-        return None
-
-    # Simple weighted random or priority based selection
-    # For now, let's just pick one with the highest priority
-    max_priority = max(k.priority for k in keys)
-    top_keys = [k for k in keys if k.priority == max_priority]
-    return random.choice(top_keys)
+    random.shuffle(keys)
+    keys.sort(key=lambda k: (-k.priority, key_stats.score(k.id)))
+    selected = []
+    for key in keys:
+        if len(selected) == limit:
+            break
+        if not is_saturated(key.id) and breaker.allow(key.id):
+            selected.append(key)
+    return selected
+
+def get_provider_key(db: Session, model: str):
+    """Retrieves the single preferred active provider key for the given model."""
+    keys = get_provider_keys(db, model, limit=1)
+    return keys[0] if keys else None
 
 def add_provider_key(db: Session, provider: str, api_key: str, priority: int = 1, config: dict = None):
     new_key = ProviderKey(provider=provider, api_key=api_key, priority=priority, config=config)
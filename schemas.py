@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import List, Union, Literal, Optional, Dict, Any
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Annotated, List, Union, Literal, Optional, Dict, Any
 
 
 class TextContent(BaseModel):
@@ -12,7 +12,8 @@ class ImageURL(BaseModel):
     image_url: Dict[str, Any]
 
 
-ContentItem = Union[TextContent, ImageURL]
+# Dispatch on `type` instead of trying each arm in turn
+ContentItem = Annotated[Union[TextContent, ImageURL], Field(discriminator="type")]
 
 
 class Message(BaseModel):
@@ -35,6 +36,8 @@ class Tool(BaseModel):
 
 
 class CompletionRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     model: str = Field(..., description="مدل هوش مصنوعی مورد استفاده")
     messages: List[Message] = Field(..., min_length=1, description="لیست پیام‌های گفتگو")
 
@@ -56,6 +59,23 @@ class CompletionRequest(BaseModel):
     tool_choice: Optional[Union[str, dict]] = Field(None, description="انتخاب ابزار")
     stream: Optional[bool] = Field(False, description="فعال‌سازی استریمینگ")
 
+
+def _inline_refs(schema: dict) -> dict:
+    """Resolves pydantic's local `$defs` refs so the schema can sit inside an OpenAPI operation."""
+    defs = schema.pop("$defs", {})
+    def resolve(node):
+        if isinstance(node, dict):
+            if "$ref" in node: return resolve(defs[node["$ref"].rsplit("/", 1)[-1]])
+            return {k: resolve(v) for k, v in node.items()}
+        if isinstance(node, list): return [resolve(v) for v in node]
+        return node
+    return resolve(schema)
+
+# The chat endpoint validates its raw body itself, so its request schema is declared explicitly for /docs.
+COMPLETION_REQUEST_OPENAPI = {"requestBody": {"required": True, "content": {
+    "application/json": {"schema": _inline_refs(CompletionRequest.model_json_schema())}
+}}}
+
 class ChatCompletionResponse(BaseModel):
     id: str = Field(..., description="شناسه منحصر به فرد")
     object: Literal["chat.completion"] = Field(..., description="نوع شیء")
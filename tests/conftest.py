@@ -0,0 +1,68 @@
+import os
+import time
+
+# A small chat limit so rate-limit tests send a handful of requests; main reads it at import.
+os.environ.setdefault("CHAT_RATE_LIMIT", "3/minute")
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import main
+import models
+from database import Base, get_db, engine_kwargs
+from main import app, cache, limiter
+
+engine = create_engine("sqlite://", poolclass=StaticPool, **{**engine_kwargs, "connect_args": {"check_same_thread": False}})
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    session = TestingSessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(bind=engine)
+
+@pytest.fixture(scope="session", autouse=True)
+def log_dir(tmp_path_factory):
+    """Points the lifespan's log sinks at a temporary directory instead of ./logs."""
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(main, "LOG_DIR", str(tmp_path_factory.mktemp("logs")))
+        yield
+
+@pytest.fixture(scope="session")
+def client(log_dir):
+    """One TestClient for the whole run; entering it runs the app's startup and shutdown exactly once."""
+    with TestClient(app) as c:
+        yield c
+
+@pytest.fixture
+def api_client(db, client):
+    """The shared TestClient backed by an in-memory database with one active provider key."""
+    db.add(models.ProviderKey(provider="openai", api_key="sk-provider", priority=1))
+    db.commit()
+    app.dependency_overrides[get_db] = lambda: db
+    cache.clear()
+    limiter.reset()
+    yield client
+    app.dependency_overrides.clear()
+    cache.clear()
+
+@pytest.fixture
+def frozen_rate_limit_clock(mocker):
+    """
+    Pins the limits library's clock: the sliding-window counter decays the previous window's
+    count, so a window rollover mid-test could otherwise let the over-limit request through.
+    """
+    clock = mocker.Mock()
+    clock.time.return_value = time.time()
+    mocker.patch("limits.storage.memory.time", clock)
+    mocker.patch("limits.strategies.time", clock)
+    limiter.reset()
+    yield
+    limiter.reset()
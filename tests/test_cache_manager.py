@@ -0,0 +1,90 @@
+import asyncio
+from cache_manager import LRUTTLCache, ResponseCache, SingleFlight, memory_pressure
+from utils import compute_etag
+
+class FakeRedis:
+    def __init__(self): self.store = {}
+    async def get(self, key): return self.store.get(key)
+    async def set(self, key, value, ex=None): self.store[key] = value
+
+def test_l1_only_cache_roundtrip():
+    rc = ResponseCache(LRUTTLCache(maxsize=8, ttl=60))
+    async def scenario():
+        assert await rc.get(b"k") is None
+        await rc.set(b"k", b'{"id":1}')
+        return await rc.get(b"k")
+    assert asyncio.run(scenario()) == (b'{"id":1}', compute_etag(b'{"id":1}'))
+
+def test_l2_hit_populates_l1():
+    redis = FakeRedis()
+    writer = ResponseCache(LRUTTLCache(maxsize=8, ttl=60), redis)
+    reader = ResponseCache(LRUTTLCache(maxsize=8, ttl=60), redis)
+    async def scenario():
+        await writer.set(b"k", b'{"id":1}')
+        return await reader.get(b"k")
+    assert asyncio.run(scenario())[0] == b'{"id":1}'
+    assert reader.l1[b"k"] == writer.l1[b"k"]
+
+def test_byte_bounded_l1_skips_oversized_bodies():
+    l1 = LRUTTLCache(maxsize=16, ttl=60, getsizeof=lambda entry: len(entry[0]))
+    rc = ResponseCache(l1)
+    async def scenario():
+        await rc.set(b"small", b"0123456789")
+        await rc.set(b"huge", b"x" * 32)
+        return await rc.get(b"huge")
+    assert asyncio.run(scenario()) is None
+    assert l1.currsize == 10
+
+def test_large_bodies_are_not_cached(mocker):
+    redis = FakeRedis()
+    rc = ResponseCache(LRUTTLCache(maxsize=8, ttl=60), redis)
+    mocker.patch("cache_manager.CACHE_MAX_ENTRY_BYTES", 4)
+    body, etag = asyncio.run(rc.set(b"k", b"too large"))
+    assert body == b"too large" and etag == compute_etag(body)
+    assert len(rc.l1) == 0 and redis.store == {}
+
+def test_single_flight_collapses_concurrent_calls():
+    flights = SingleFlight()
+    calls = []
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+    async def scenario():
+        return await asyncio.gather(*(flights.do(b"k", work) for _ in range(5)))
+    assert asyncio.run(scenario()) == ["result"] * 5
+    assert len(calls) == 1
+    assert flights.inflight == {}
+
+def test_single_flight_shares_errors_and_forgets_the_key():
+    flights = SingleFlight()
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+    async def scenario():
+        return await asyncio.gather(flights.do(b"k", fail), flights.do(b"k", fail), return_exceptions=True)
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert flights.inflight == {}
+
+def test_lru_ttl_cache_expires_lazily_and_evicts_lru():
+    now = [0.0]
+    c = LRUTTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+    c["a"] = 1; c["b"] = 2
+    assert c["a"] == 1
+    c["c"] = 3
+    assert "b" not in c and c["a"] == 1
+    now[0] = 11
+    assert "a" not in c and len(c) == 1
+
+def test_memory_pressure_scales_between_thresholds():
+    assert memory_pressure(0.5) == 0.0
+    assert abs(memory_pressure(0.8) - 0.5) < 1e-9
+    assert memory_pressure(0.95) == 1.0
+
+def test_evict_oldest_drops_lru_entries():
+    c = LRUTTLCache(maxsize=10, ttl=60)
+    for key in "abcd": c[key] = key
+    c["a"]
+    assert c.evict_oldest(2) == 2
+    assert "b" not in c and "c" not in c and "a" in c and "d" in c
@@ -1,15 +1,27 @@
+import asyncio
+import threading
+import time
+import httpx
+import litellm
 import pytest
-from fastapi.testclient import TestClient
-from main import app
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.websockets import WebSocket, WebSocketDisconnect
+import main
+import models
+import schemas
+from main import app, ConnectionManager, TIMEOUT_HTTP, BatchSink, cache, hash_key, limiter, rate_limit_key, relieve_memory_pressure, verify_api_key
+from utils import ORJSONResponse
 
-client = TestClient(app)
+CHAT_PAYLOAD = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}
 
-def test_read_main():
+def test_read_main(client):
     response = client.get("/")
     assert response.status_code == 200
     assert "AI Proxy v3.2" in response.text
+    assert response.headers["content-type"] == "text/html; charset=utf-8"
 
-def test_register():
+def test_register(client):
     # Test user registration (will fail if admin already exists, but good for flow check)
     response = client.post("/register", json={
         "username": "testuser",
@@ -17,3 +29,383 @@ def test_register():
         "password": "password123"
     })
     assert response.status_code in [200, 400]
+
+def test_shared_http_client_lifecycle(client, monkeypatch):
+    # The session-wide client has run startup, so the app is serving with its pooled client.
+    assert isinstance(app.state.http, httpx.AsyncClient)
+    assert litellm.aclient_session is app.state.http
+    # A second lifespan on a throwaway app covers shutdown; the shared session is restored afterwards.
+    monkeypatch.setattr(litellm, "aclient_session", litellm.aclient_session)
+    async def scenario():
+        other = FastAPI()
+        async with main.lifespan(other):
+            assert litellm.aclient_session is other.state.http
+        assert litellm.aclient_session is None and other.state.http.is_closed
+    asyncio.run(scenario())
+
+def test_orjson_response_renders_json():
+    response = ORJSONResponse(content={"model": "gpt", "choices": []})
+    assert response.body == b'{"model":"gpt","choices":[]}'
+    assert response.media_type == "application/json"
+
+class FakeChunk:
+    def __init__(self, content):
+        self.content = content
+    def model_dump(self):
+        return {"choices": [{"delta": {"content": self.content}}]}
+
+class FakeCompletion:
+    """Plain stand-in for a non-streaming litellm response; only model_dump() is read."""
+    def __init__(self, choices=()):
+        self.choices = list(choices)
+    def model_dump(self):
+        return {"choices": self.choices, "usage": {}}
+
+def test_stream_forwards_sse_chunks(api_client, mocker):
+    async def fake_stream():
+        for part in ("Hel", "lo"): yield FakeChunk(part)
+    mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=fake_stream()))
+    response = api_client.post(
+        "/api/v1/chat/completions",
+        json={**CHAT_PAYLOAD, "stream": True},
+        headers={"Authorization": "Bearer test-api-key"},
+    )
+    assert response.status_code == 200
+    assert response.text == (
+        'data: {"choices":[{"delta":{"content":"Hel"}}]}\n\n'
+        'data: {"choices":[{"delta":{"content":"lo"}}]}\n\n'
+        "data: [DONE]\n\n"
+    )
+
+def test_connection_manager_connect_and_disconnect():
+
+    class FakeWebSocket:
+        async def accept(self): pass
+
+    async def scenario():
+        mgr, ws = ConnectionManager(), FakeWebSocket()
+        await mgr.connect(ws, 1)
+        assert mgr.active_connections == {1: ws}
+        mgr.disconnect(1)
+        mgr.disconnect(1)
+        return mgr.active_connections
+
+    assert asyncio.run(scenario()) == {}
+
+@pytest.mark.parametrize("auth, frames", [
+    pytest.param({}, ['{"choices":[{"delta":{"content":"Hel"}}]}', '{"choices":[{"delta":{"content":"lo"}}]}'], id="frame_per_chunk"),
+    pytest.param({"coalesce": True}, ['{"choices":[{"delta":{"content":"Hel"}}]}\n{"choices":[{"delta":{"content":"lo"}}]}'], id="coalesce"),
+])
+def test_websocket_stream_coalesces_chunks_only_on_request(api_client, mocker, auth, frames):
+    async def fake_stream():
+        for part in ("Hel", "lo"): yield FakeChunk(part)
+    mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=fake_stream()))
+    mocker.patch("main.WS_FLUSH_INTERVAL", 60)
+    with api_client.websocket_connect("/ws/v1/chat/completions") as websocket:
+        websocket.send_json({"api_key": "test-api-key", **auth})
+        websocket.send_json(CHAT_PAYLOAD)
+        assert [websocket.receive_text() for _ in frames] == frames
+        assert websocket.receive_text() == "[DONE]"
+
+def test_logging_middleware_logs_status(client, mocker):
+    mock_info = mocker.patch("main.logger.info")
+    mock_debug = mocker.patch("main.logger.debug")
+    client.get("/")
+    client.get("/static/index.html")
+    client.get("/does-not-exist")
+    assert any(call.args[1:4] == ("GET", "/", 200) for call in mock_debug.call_args_list)
+    assert not any("/static/index.html" in call.args for call in mock_debug.call_args_list)
+    assert any(call.args[1:4] == ("GET", "/does-not-exist", 404) for call in mock_info.call_args_list)
+
+def test_logging_middleware_promotes_slow_requests(client, mocker):
+    mocker.patch("main.SLOW_REQUEST_NS", 0)
+    mock_info = mocker.patch("main.logger.info")
+    client.get("/")
+    assert any(call.args[1:4] == ("GET", "/", 200) for call in mock_info.call_args_list)
+
+def test_completion_uses_phase_timeouts(api_client, mocker):
+    mock_completion = mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=FakeCompletion()))
+    mocker.patch("main.litellm.completion_cost", return_value=0.0)
+    response = api_client.post(
+        "/api/v1/chat/completions",
+        json=CHAT_PAYLOAD,
+        headers={"Authorization": "Bearer test-api-key"},
+    )
+    assert response.status_code == 200
+    assert mock_completion.call_args.kwargs["timeout"] is TIMEOUT_HTTP
+
+def test_usage_log_json_roundtrip(db):
+    log = models.UsageLog(model="gpt-4o", request_data={"messages": [{"role": "user", "content": "سلام"}]}, response_data={"choices": []})
+    db.add(log); db.commit(); db.expire_all()
+    assert db.query(models.UsageLog).one().request_data["messages"][0]["content"] == "سلام"
+
+class Key:
+    def __init__(self, id, priority=1): self.id, self.priority = id, priority
+
+@pytest.mark.parametrize("attempts, winner", [
+    pytest.param([(Key(1), {"api_key": "slow", "delay": 1}), (Key(2), {"api_key": "fast", "delay": 0})], "fast", id="slow_then_fast"),
+    pytest.param([(Key(3), {"api_key": "bad", "delay": 0, "fail": True}), (Key(4), {"api_key": "ok", "delay": 0})], "ok", id="fail_then_ok"),
+])
+def test_hedged_completion_prefers_first_success(mocker, attempts, winner):
+    async def fake_acompletion(api_key, delay, fail=False):
+        await asyncio.sleep(delay)
+        if fail: raise RuntimeError(api_key)
+        return api_key
+    mocker.patch("main.acompletion", fake_acompletion)
+    assert asyncio.run(main.hedged_completion(attempts, hedge_delay=0.01)) == winner
+
+def test_http_errors_keep_detail_and_headers(client):
+    response = client.post("/token", data={"username": "nobody", "password": "wrong"})
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Incorrect username or password"}
+    assert response.headers["www-authenticate"] == "Bearer"
+    assert client.get("/missing").json() == {"detail": "Not Found"}
+
+@pytest.mark.parametrize("first_frame, error", [
+    pytest.param(b'{"api_key": "Bearer nope"}', "Invalid API Key", id="invalid_key"),
+    pytest.param(b"not json", "Invalid JSON", id="bad_json"),
+])
+def test_websocket_rejects_invalid_key_and_bad_json(api_client, db, first_frame, error):
+    db.add(models.User(username="owner", email="owner@example.com", hashed_password="x")); db.commit()
+    with api_client.websocket_connect("/ws/v1/chat/completions") as websocket:
+        websocket.send_bytes(first_frame)
+        assert websocket.receive_json() == {"error": error}
+
+def test_completion_flight_outlives_its_leader_on_its_own_session(db, mocker):
+    sessions, finished = [], []
+    async def fake_request_completion(body, request_data, cache_key, user, flight_db, country):
+        sessions.append(flight_db)
+        await asyncio.sleep(0.05)
+        finished.append(True)
+        return (b"{}", '"etag"')
+    mocker.patch("main.request_completion", fake_request_completion)
+    body = schemas.CompletionRequest(model="flight-test", messages=[{"role": "user", "content": "hi"}])
+    async def scenario():
+        leader = asyncio.create_task(main.handle_ai_completion(body, None, db))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        db.close()  # what get_db does when the leader request ends
+        await asyncio.sleep(0.1)
+    asyncio.run(scenario())
+    assert finished and sessions[0] is not db and sessions[0].get_bind() is db.get_bind()
+
+def test_cached_completion_honors_if_none_match(api_client, mocker):
+    mock_completion = mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=FakeCompletion([{"message": {"content": "hi"}}])))
+    mocker.patch("main.litellm.completion_cost", return_value=0.0)
+    headers = {"Authorization": "Bearer test-api-key"}
+    first = api_client.post("/api/v1/chat/completions", json=CHAT_PAYLOAD, headers=headers)
+    assert first.json()["choices"][0]["message"]["content"] == "hi"
+    assert first.headers["x-cache"] == "MISS"
+    etag = first.headers["etag"]
+    second = api_client.post("/api/v1/chat/completions", json=CHAT_PAYLOAD, headers={**headers, "If-None-Match": etag})
+    assert second.status_code == 304 and second.content == b""
+    assert second.headers["x-cache"] == "HIT"
+    assert mock_completion.await_count == 1
+
+@pytest.mark.parametrize("priorities, expected_calls", [
+    pytest.param((1, 1, 1), ["a", "b"], id="one_extra_call_at_most"),
+    pytest.param((2, 1, 1), ["a"], id="no_hedge_to_lower_priority"),
+])
+def test_hedging_is_capped_and_stays_in_the_top_priority_tier(mocker, priorities, expected_calls):
+    calls = []
+    async def slow_acompletion(api_key):
+        calls.append(api_key)
+        await asyncio.sleep(0.1)
+        return api_key
+    mocker.patch("main.acompletion", slow_acompletion)
+    attempts = [(Key(10 + i, p), {"api_key": name}) for i, (p, name) in enumerate(zip(priorities, "abc"))]
+    assert asyncio.run(main.hedged_completion(attempts, hedge_delay=0.01)) == "a"
+    assert calls == expected_calls
+
+def test_slow_provider_is_not_raced_by_default(mocker):
+    calls = []
+    async def slow_acompletion(api_key):
+        calls.append(api_key)
+        await asyncio.sleep(0.2)
+        return api_key
+    mocker.patch("main.acompletion", slow_acompletion)
+    attempts = [(Key(20 + i), {"api_key": f"k{i}"}) for i in range(main.MAX_PROVIDER_ATTEMPTS)]
+    assert asyncio.run(main.hedged_completion(attempts, main.HEDGE_DELAY)) == "k0"
+    assert calls == ["k0"]
+
+def test_full_bulkhead_rejects_calls_instead_of_queueing(mocker):
+    async def slow_acompletion(api_key):
+        await asyncio.sleep(0.05)
+        return api_key
+    mocker.patch("main.acompletion", slow_acompletion)
+    mocker.patch.dict(main.key_semaphores, {30: asyncio.Semaphore(1)})
+    async def scenario():
+        return await asyncio.gather(*(main.call_provider(Key(30), {"api_key": "k"}) for _ in range(5)), return_exceptions=True)
+    results = asyncio.run(scenario())
+    assert results.count("k") == 1
+    assert sum(isinstance(r, main.KeySaturatedError) for r in results) == 4
+
+def test_hedged_completion_raises_last_error_when_all_fail(mocker):
+    async def failing_acompletion(api_key):
+        raise RuntimeError(api_key)
+    mocker.patch("main.acompletion", failing_acompletion)
+    attempts = [(Key(5), {"api_key": "a"}), (Key(6), {"api_key": "b"}), (Key(7), {"api_key": "c"})]
+    with pytest.raises(RuntimeError, match="c"):
+        asyncio.run(main.hedged_completion(attempts, hedge_delay=0.01))
+
+def test_websocket_binary_frames_opt_in(api_client, mocker):
+    async def fake_stream():
+        yield FakeChunk("Hi")
+    mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=fake_stream()))
+    with api_client.websocket_connect("/ws/v1/chat/completions") as websocket:
+        websocket.send_json({"api_key": "test-api-key", "binary": True})
+        websocket.send_json(CHAT_PAYLOAD)
+        assert websocket.receive_bytes() == b'{"choices":[{"delta":{"content":"Hi"}}]}'
+        assert websocket.receive_text() == "[DONE]"
+
+def test_websocket_flushes_buffer_while_upstream_is_idle(api_client, mocker):
+    async def fake_stream():
+        yield FakeChunk("first")
+        await asyncio.sleep(0.2)
+        yield FakeChunk("second")
+    mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=fake_stream()))
+    mocker.patch("main.WS_FLUSH_INTERVAL", 0.01)
+    with api_client.websocket_connect("/ws/v1/chat/completions") as websocket:
+        websocket.send_json({"api_key": "test-api-key"})
+        websocket.send_json(CHAT_PAYLOAD)
+        assert websocket.receive_text() == '{"choices":[{"delta":{"content":"first"}}]}'
+        assert websocket.receive_text() == '{"choices":[{"delta":{"content":"second"}}]}'
+        assert websocket.receive_text() == "[DONE]"
+
+def test_bearer_prefix_only_stripped_once(db):
+    user = models.User(username="bearer-user", hashed_password="x")
+    db.add(user)
+    db.commit()
+    db.add(models.APIKey(key=hash_key("abcBearer xyz"), user_id=user.id, is_active=True))
+    db.commit()
+    request = Request({"type": "http", "headers": [(b"authorization", b"Bearer abcBearer xyz")], "query_string": b""})
+    assert asyncio.run(verify_api_key(request, db)).username == "bearer-user"
+
+def test_invalid_chat_body_is_rejected_with_422(api_client):
+    headers = {"Authorization": "Bearer test-api-key"}
+    response = api_client.post("/api/v1/chat/completions", json={"model": "gpt-4o", "messages": []}, headers=headers)
+    assert response.status_code == 422 and response.json()["detail"][0]["loc"] == ["body", "messages"]
+    response = api_client.post("/api/v1/chat/completions", content=b"{not json", headers=headers)
+    assert response.status_code == 422
+    schema = app.openapi()["paths"]["/api/v1/chat/completions"]["post"]["requestBody"]["content"]["application/json"]["schema"]
+    assert "messages" in schema["properties"]
+
+def test_chat_rate_limit_is_per_api_key(api_client, mocker, frozen_rate_limit_clock):
+    mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=FakeCompletion()))
+    mocker.patch("main.litellm.completion_cost", return_value=0.0)
+    post = lambda key: api_client.post("/api/v1/chat/completions", json=CHAT_PAYLOAD, headers={"Authorization": f"Bearer {key}"})
+    for _ in range(main.CHAT_RATE_LIMIT.amount): assert post("test-api-key").status_code == 200
+    limited = post("test-api-key")
+    assert limited.status_code == 429 and limited.json()["error"].startswith("Rate limit exceeded")
+    assert post("other-key").status_code != 429
+
+def test_websocket_rate_limit_hit_runs_off_the_event_loop_with_redis(mocker):
+    threads = []
+    def hit(*args):
+        threads.append(threading.get_ident())
+        return True
+    mocker.patch("main.REDIS_URL", "redis://localhost:6379/0")
+    mocker.patch.object(limiter.limiter, "hit", hit)
+    assert asyncio.run(main.ws_rate_limit_ok("k"))
+    assert threads and threads[0] != threading.get_ident()
+
+def test_rate_limit_key_does_not_contain_the_raw_api_key(mocker):
+    request = mocker.Mock()
+    request.headers = {"Authorization": "Bearer sk-secret"}
+    key = rate_limit_key(request)
+    assert "sk-secret" not in key and key == "key:" + hash_key("sk-secret")
+
+def test_websocket_is_rejected_once_http_exhausts_the_chat_rate_limit(api_client, mocker, frozen_rate_limit_clock):
+    mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=FakeCompletion()))
+    mocker.patch("main.litellm.completion_cost", return_value=0.0)
+    headers = {"Authorization": "Bearer test-api-key"}
+    codes = [api_client.post("/api/v1/chat/completions", json=CHAT_PAYLOAD, headers=headers).status_code
+             for _ in range(main.CHAT_RATE_LIMIT.amount + 1)]
+    assert codes[-1] == 429 and 429 not in codes[:-1]
+    with api_client.websocket_connect("/ws/v1/chat/completions") as websocket:
+        websocket.send_json({"api_key": "test-api-key"})
+        assert websocket.receive_json() == {"error": "Rate limit exceeded"}
+
+def test_websocket_aborts_stream_for_slow_client(api_client, mocker):
+    upstream = {"sent": 0, "closed": False}
+    async def fake_stream():
+        try:
+            while True:
+                upstream["sent"] += 1
+                yield FakeChunk("x")
+        finally: upstream["closed"] = True
+    async def stalled_send(self, data): await asyncio.sleep(10)
+    mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=fake_stream()))
+    mocker.patch("main.WS_QUEUE_MAX", 2)
+    mocker.patch("main.WS_SLOW_CLIENT_TIMEOUT", 0.2)
+    disconnect = mocker.spy(main.manager, "disconnect")
+    with api_client.websocket_connect("/ws/v1/chat/completions") as websocket:
+        websocket.send_json({"api_key": "test-api-key"})
+        mocker.patch.object(WebSocket, "send_text", stalled_send)
+        websocket.send_json(CHAT_PAYLOAD)
+        with pytest.raises(WebSocketDisconnect): websocket.receive_text()
+    assert disconnect.called
+    assert upstream["closed"]
+    # Backpressure: the frame being sent, the queued chunks and the one awaiting a slot.
+    assert upstream["sent"] <= 1 + 2 + 1
+
+def test_memory_pressure_trims_response_cache(mocker):
+    cache.clear()
+    for i in range(4): cache[bytes([i])] = (b"x", '"etag"')
+    mocker.patch("main.psutil.virtual_memory", return_value=mocker.Mock(percent=80.0))
+    assert relieve_memory_pressure() == 2
+    assert len(cache) == 2
+    mocker.patch("main.psutil.virtual_memory", return_value=mocker.Mock(percent=50.0))
+    assert relieve_memory_pressure() == 0
+    cache.clear()
+
+def test_batch_sink_buffers_flushes_on_a_timer_and_rotates(tmp_path):
+    path = tmp_path / "app.log"
+    sink = BatchSink(str(path), buffer_bytes=1000, flush_seconds=0.05, rotation_bytes=100, retention_seconds=3600)
+    try:
+        sink.write("x" * 40 + "\n")
+        assert not path.exists()
+        deadline = time.monotonic() + 2
+        while not path.exists() and time.monotonic() < deadline: time.sleep(0.01)
+        assert path.read_text() == "x" * 40 + "\n"
+        sink.write("y" * 80 + "\n")
+        sink.flush_buffer()
+    finally:
+        sink.stop()
+    assert path.read_text() == "y" * 80 + "\n"
+    rotated = [p for p in tmp_path.iterdir() if p != path]
+    assert len(rotated) == 1 and rotated[0].read_text() == "x" * 40 + "\n"
+
+def test_batch_sink_writes_once_the_buffer_fills(tmp_path):
+    path = tmp_path / "app.log"
+    sink = BatchSink(str(path), buffer_bytes=50, flush_seconds=60, rotation_bytes=10_000, retention_seconds=3600)
+    try:
+        sink.write("a" * 30 + "\n")
+        assert not path.exists()
+        sink.write("b" * 30 + "\n")
+        assert path.read_text() == "a" * 30 + "\n" + "b" * 30 + "\n"
+    finally:
+        sink.stop()
+
+def test_access_log_is_sampled_under_cpu_load(client, mocker):
+    mocker.patch("main.CPU_PERCENT", 99.0)
+    mock_debug = mocker.patch("main.logger.debug")
+    mock_info = mocker.patch("main.logger.info")
+    for _ in range(32): client.get("/")
+    client.get("/does-not-exist")
+    assert sum(call.args[2] == "/" for call in mock_debug.call_args_list) == 2
+    assert any(call.args[1:4] == ("GET", "/does-not-exist", 404) for call in mock_info.call_args_list)
+
+def test_websocket_drops_client_when_send_stalls(api_client, mocker):
+    async def fake_stream():
+        yield FakeChunk("hi")
+    async def stalled_send(self, data): await asyncio.sleep(10)
+    mocker.patch("main.acompletion", new=mocker.AsyncMock(return_value=fake_stream()))
+    mocker.patch("main.WS_SLOW_CLIENT_TIMEOUT", 0.05)
+    disconnect = mocker.spy(main.manager, "disconnect")
+    with api_client.websocket_connect("/ws/v1/chat/completions") as websocket:
+        websocket.send_json({"api_key": "test-api-key"})
+        mocker.patch.object(WebSocket, "send_text", stalled_send)
+        websocket.send_json(CHAT_PAYLOAD)
+        with pytest.raises(WebSocketDisconnect): websocket.receive_text()
+    assert disconnect.called
@@ -0,0 +1,81 @@
+import asyncio
+import litellm
+import models
+from provider_manager import CircuitBreaker, KeyStats, get_provider_keys, is_upstream_failure, key_semaphores
+
+def test_breaker_opens_after_threshold():
+    cb = CircuitBreaker(failure_threshold=2, open_seconds=60)
+    cb.record_failure(1)
+    assert cb.allow(1)
+    cb.record_failure(1)
+    assert not cb.allow(1)
+    assert cb.allow(2)
+
+def test_breaker_half_open_limits_probes_and_recovers():
+    cb = CircuitBreaker(failure_threshold=1, open_seconds=0, half_open_requests=2)
+    cb.record_failure(1)
+    assert cb.begin_call(1) and cb.begin_call(1)
+    assert not cb.allow(1) and not cb.begin_call(1)
+    cb.record_success(1)
+    assert cb.allow(1)
+
+def test_breaker_selection_does_not_use_up_probes():
+    cb = CircuitBreaker(failure_threshold=1, open_seconds=0, half_open_requests=1)
+    cb.record_failure(7)
+    # Hedging selects backup keys that are never called; that must not exhaust the probe.
+    for _ in range(3): assert cb.allow(7)
+    assert cb.begin_call(7)
+    assert not cb.allow(7)
+    cb.release_probe(7)
+    assert cb.allow(7)
+
+def test_breaker_half_open_failure_reopens():
+    cb = CircuitBreaker(failure_threshold=1, open_seconds=0)
+    cb.record_failure(1)
+    assert cb.allow(1)
+    cb.record_failure(1)
+    assert cb.breakers[1].state == "open"
+
+def test_only_server_errors_trip_breaker():
+    assert is_upstream_failure(litellm.Timeout(message="t", model="m", llm_provider="openai"))
+    assert is_upstream_failure(litellm.ServiceUnavailableError(message="down", model="m", llm_provider="openai"))
+    assert not is_upstream_failure(litellm.BadRequestError(message="bad", model="m", llm_provider="openai"))
+
+def test_saturated_keys_are_skipped(db):
+    busy = models.ProviderKey(provider="openai", api_key="busy", priority=2)
+    idle = models.ProviderKey(provider="openai", api_key="idle", priority=1)
+    db.add_all([busy, idle]); db.commit()
+    key_semaphores[busy.id] = asyncio.Semaphore(0)
+    try:
+        assert [k.api_key for k in get_provider_keys(db, "gpt-4o")] == ["idle"]
+    finally:
+        key_semaphores.pop(busy.id)
+    assert [k.api_key for k in get_provider_keys(db, "gpt-4o")] == ["busy", "idle"]
+
+def test_equal_priority_keys_ordered_by_latency_and_failures(db, mocker):
+    for name in ("slow", "fast", "flaky"):
+        db.add(models.ProviderKey(provider="openai", api_key=name, priority=1, is_active=True))
+    db.commit()
+    ids = {k.api_key: k.id for k in db.query(models.ProviderKey).all()}
+    stats = KeyStats()
+    stats.record(ids["slow"], 2.0, ok=True)
+    stats.record(ids["fast"], 0.1, ok=True)
+    stats.record(ids["flaky"], 0.1, ok=False)
+    mocker.patch("provider_manager.key_stats", stats)
+    assert [k.api_key for k in get_provider_keys(db, "gpt-4o", limit=3)] == ["fast", "slow", "flaky"]
+
+def test_penalised_key_is_retried_once_its_score_decays(db, mocker):
+    for name in ("healthy", "flaky"):
+        db.add(models.ProviderKey(provider="openai", api_key=name, priority=1, is_active=True))
+    db.commit()
+    ids = {k.api_key: k.id for k in db.query(models.ProviderKey).all()}
+    clock = mocker.patch("provider_manager.time.monotonic", return_value=1000.0)
+    stats = KeyStats(half_life=60.0)
+    stats.record(ids["flaky"], 0.1, ok=False)
+    stats.record(ids["healthy"], 0.5, ok=True)
+    mocker.patch("provider_manager.key_stats", stats)
+    assert [k.api_key for k in get_provider_keys(db, "gpt-4o", limit=2)] == ["healthy", "flaky"]
+    # The healthy key keeps being sampled; the skipped flaky key's penalty decays until it is tried again.
+    clock.return_value = 1000.0 + 6 * 60
+    stats.record(ids["healthy"], 0.5, ok=True)
+    assert [k.api_key for k in get_provider_keys(db, "gpt-4o", limit=2)] == ["flaky", "healthy"]
@@ -0,0 +1,19 @@
+import pytest
+from pydantic import ValidationError
+from schemas import CompletionRequest, ImageURL, TextContent
+
+def test_content_parts_dispatch_on_type():
+    body = CompletionRequest(model="gpt-4o", messages=[{"role": "user", "content": [
+        {"type": "text", "text": "describe"},
+        {"type": "image_url", "image_url": {"url": "https://example.com/a.png"}},
+    ]}])
+    parts = body.messages[0].content
+    assert isinstance(parts[0], TextContent) and isinstance(parts[1], ImageURL)
+
+def test_unknown_content_type_rejected():
+    with pytest.raises(ValidationError):
+        CompletionRequest(model="gpt-4o", messages=[{"role": "user", "content": [{"type": "video", "url": "x"}]}])
+
+def test_unknown_request_fields_ignored():
+    body = CompletionRequest(model="gpt-4o", messages=[{"role": "user", "content": "hi"}], user_tag="x")
+    assert "user_tag" not in body.model_dump()
@@ -0,0 +1,14 @@
+from utils import COMMON_ERROR_BODIES, error_body, generate_cache_key
+
+def test_cache_key_ignores_dict_order():
+    a = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}
+    b = {"messages": [{"content": "hi", "role": "user"}], "model": "gpt-4o"}
+    assert generate_cache_key(a) == generate_cache_key(b)
+
+def test_cache_key_differs_per_request():
+    assert generate_cache_key({"model": "a"}) != generate_cache_key({"model": "b"})
+
+def test_error_body_reuses_only_common_details():
+    assert error_body("Not Found") is COMMON_ERROR_BODIES["Not Found"]
+    assert error_body("AI Provider Error: boom") == b'{"detail":"AI Provider Error: boom"}'
+    assert "AI Provider Error: boom" not in COMMON_ERROR_BODIES
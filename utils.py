@@ -1,7 +1,34 @@
-import json
-import hashlib
 from functools import lru_cache
+from http import HTTPStatus
+import orjson
+import xxhash
+from fastapi.responses import JSONResponse
 
-def generate_cache_key(request_data: dict) -> str:
-    """Generate a unique key for caching based on request data."""
-    return hashlib.sha256(json.dumps(request_data, sort_keys=True).encode()).hexdigest()
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson instead of the stdlib json module."""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+def generate_cache_key(request_data: dict) -> bytes:
+    """Generate a unique key for caching based on request data (16-byte binary digest)."""
+    return xxhash.xxh3_128_digest(orjson.dumps(request_data, option=orjson.OPT_SORT_KEYS))
+
+# Starlette's default detail for the common error statuses, plus the auth rejections every bad key hits.
+COMMON_ERROR_DETAILS = [HTTPStatus(code).phrase for code in (400, 401, 403, 404, 405, 409, 422, 500, 502, 503, 504)] + [
+    "Invalid API Key", "Missing or invalid Authorization header", "Could not validate credentials",
+]
+COMMON_ERROR_BODIES = {detail: orjson.dumps({"detail": detail}) for detail in COMMON_ERROR_DETAILS}
+
+def error_body(detail: str) -> bytes:
+    """Encoded {"detail": ...} payload; fixed common messages are pre-encoded, anything else
+    (e.g. upstream error text) is encoded directly rather than cached."""
+    body = COMMON_ERROR_BODIES.get(detail)
+    return body if body is not None else orjson.dumps({"detail": detail})
+
+@lru_cache(maxsize=64)
+def rate_limit_body(detail: str) -> bytes:
+    """Encoded 429 payload, same shape as slowapi's default handler; one per configured limit."""
+    return orjson.dumps({"error": f"Rate limit exceeded: {detail}"})
+
+def compute_etag(body: bytes) -> str:
+    return f'"{xxhash.xxh3_128_hexdigest(body)}"'